@@ -4,217 +4,289 @@ Clean and combine extracted CHM HTML files into a single ebook-ready HTML file.
 Removes navigation, branding, and old web artifacts.
 """
 
+import multiprocessing
+import os
 import re
 from pathlib import Path
-from bs4 import BeautifulSoup, NavigableString, Comment
+from bs4 import BeautifulSoup, NavigableString, Comment, SoupStrainer, UnicodeDammit
+from bs4.dammit import EncodingDetector
+
+# Parser used for every BeautifulSoup call; lxml is far faster than html.parser
+PARSER = 'lxml'
+
+# Only <body> is kept when parsing chapter files; <head> (CSS, scripts) is skipped
+BODY_STRAINER = SoupStrainer('body')
+
+# Keywords that indicate navigation/branding content
+NAV_KEYWORDS = [
+    'orders', 'comments', 'mcgraw-hill', 'copyright', 'terms of use',
+    'beta books', 'contact us', 'order information', 'online catalog',
+    'privacy policy', 'all rights reserved', 'professional book group',
+    'division of', 'computing mcgraw', 'megaspace.com'
+]
+
+# File names of images used for navigation
+NAV_IMG_NAMES = frozenset({
+    'hotkey.gif', 'order_text.gif', 'comment_text.gif',
+    'backward.gif', 'forward.gif', 'division-white.gif'
+})
+# Path separators in img src values (CHM pages may use Windows-style backslashes)
+PATH_SEP_RE = re.compile(r'[/\\]')
+
+# Phrases marking a text node as a copyright notice
+COPYRIGHT_KEYWORDS = ['© 1997', 'copyright ©', 'all rights reserved', 'beta version']
+
+# Common corrupted characters, all fixed in a single str.translate pass
+MOJIBAKE_MAP = str.maketrans({
+    'í': "'",  # Common apostrophe corruption
+    'ë': '"',  # Opening quote corruption
+    'é': '"',  # Closing quote corruption
+    'ó': "'",  # Another apostrophe variant
+    'û': '—',  # Em dash corruption
+    '\t': ' ',  # Replace tabs with spaces for better display
+})
+
+# Text immediately followed by a block-level tag, without a space in between
+BLOCK_SPACE_RE = re.compile(r'([a-zA-Z0-9.])(<(?:table|div|p|h[1-6])\b)')
+
+
+def contains_nav(element):
+    """Check if the text inside an element contains a navigation keyword."""
+    # One scan of the joined text; keywords split across tags still match
+    text = element.get_text().lower()
+    return any(keyword in text for keyword in NAV_KEYWORDS)
 
 
 def remove_navigation_elements(soup):
-    """Remove navigation tables, links, and branding elements."""
-    # Keywords that indicate navigation/branding content
-    nav_keywords = [
-        'orders', 'comments', 'mcgraw-hill', 'copyright', 'terms of use',
-        'beta books', 'contact us', 'order information', 'online catalog',
-        'privacy policy', 'all rights reserved', 'professional book group',
-        'division of', 'computing mcgraw', 'megaspace.com'
-    ]
-
+    """Remove navigation tables, links, and branding elements, and clean attributes."""
     # Remove "Chapter by Chapter Summary" section (duplicate TOC in intro)
     # This section contains standalone H2/H3 headings and paragraphs with chapter descriptions
-
-    # First, find and mark the "Chapter by Chapter Summary" heading and remove everything until actual content
     in_summary_section = False
-    elements_to_remove = []
 
-    for element in soup.find_all(['h2', 'h3', 'p', 'div']):
-        text = element.get_text().strip().lower()
+    def is_summary_heading(text):
+        """Check if a heading text looks like a summary/TOC entry."""
+        return (text.startswith('chapter ') and '. ' in text) or \
+               (text.startswith('appendix ') and '. ' in text) or \
+               'chapter by chapter' in text or \
+               text.startswith('part one:') or \
+               text.startswith('part two:') or \
+               'the appendices' in text
+
+    def is_nav_image(img):
+        # Drop any query string/fragment, then take the file name after either separator
+        src = img.get('src', '').split('?', 1)[0].split('#', 1)[0]
+        basename = PATH_SEP_RE.split(src)[-1].lower()
+        return basename in NAV_IMG_NAMES
+
+    def is_external_link(a):
+        href = a.get('href', '')
+        return href.startswith('http://') or href.startswith('https://') or href.startswith('mailto:')
+
+    def in_summary(tag):
+        """Track the summary section and check if a tag is part of it."""
+        nonlocal in_summary_section
+        text = tag.get_text().strip().lower()
 
         # Start of summary section
         if 'chapter by chapter' in text:
             in_summary_section = True
-            elements_to_remove.append(element)
-            continue
+            return True
 
-        # If we're in the summary section
+        # If we're in the summary section, mark elements that are part of the summary
         if in_summary_section:
-            # Check if this marks the end of the summary (actual chapter content starts)
-            # Look for H1 tags or specific patterns that indicate chapter start
-            if element.name == 'h1':
-                in_summary_section = False
-                continue
-
-            # Mark elements that are part of the summary for removal
             if text.startswith('part one:') or text.startswith('part two:') or \
                text.startswith('the appendices') or \
                (text.startswith('chapter ') and '. ' in text) or \
                (text.startswith('appendix ') and '. ' in text) or \
-               (element.name == 'p' and len(text) < 500):  # Description paragraphs
-                elements_to_remove.append(element)
-            elif element.name in ['h2', 'h3'] and len(text) > 5 and 'chapter' not in text.lower():
+               (tag.name == 'p' and len(text) < 500):  # Description paragraphs
+                return True
+            elif tag.name in ('h2', 'h3') and len(text) > 5 and 'chapter' not in text:
                 # Found a real content heading, exit summary section
                 in_summary_section = False
+        return False
+
+    def is_copyright_notice(string):
+        """Check if a text node is primarily navigation/copyright text."""
+        text_lower = string.lower()
+        if any(keyword in text_lower for keyword in COPYRIGHT_KEYWORDS):
+            # Only remove if it's mostly this text (not part of main content)
+            return len(string.strip()) < 200
+        return False
+
+    # Walk the tree once, in document order, with an explicit stack (deeply nested
+    # old pages would overflow Python's recursion limit). Kept tags and text nodes
+    # are recorded with the index of their parent in kept; the removal passes
+    # below then loop over these lists instead of searching the tree again.
+    kept = []
+    parents = []
+    strings = []
+    summary = []
+    stack = [(child, -1) for child in reversed(list(soup.children))]
+    while stack:
+        node, parent = stack.pop()
+        if isinstance(node, NavigableString):
+            # Remove comments
+            if isinstance(node, Comment):
+                node.extract()
+            else:
+                strings.append((node, parent))
+            continue
 
-    # Remove all marked elements
-    for element in elements_to_remove:
-        element.decompose()
+        # Remove horizontal rules, script and style tags
+        if node.name in ('hr', 'script', 'style'):
+            node.extract()
+            continue
+
+        index = len(kept)
+        if node.name in ('h2', 'h3', 'p', 'div') and in_summary(node):
+            summary.append(index)
+
+        clean_attributes(node)
+        kept.append(node)
+        parents.append(parent)
+        stack.extend((child, index) for child in reversed(list(node.children)))
+
+    # Each check depends on what earlier checks left inside a tag (e.g. a nav
+    # table inside a <font>), so the passes keep the original order. A tag is
+    # live while it and all of its ancestors are still in the tree.
+    alive = [True] * len(kept)
+
+    def live_tags(*names):
+        """Yield (index, tag) for live kept tags with these names, in document order."""
+        for i, tag in enumerate(kept):
+            if parents[i] >= 0 and not alive[parents[i]]:
+                alive[i] = False
+            elif alive[i] and tag.name in names:
+                yield i, tag
+
+    def remove(i, tag):
+        # extract() just unlinks the subtree (garbage collection frees it),
+        # unlike decompose() which walks and destroys every descendant
+        tag.extract()
+        alive[i] = False
+
+    # Remove all elements marked as part of the summary section
+    for i in summary:
+        remove(i, kept[i])
 
     # Also remove paragraphs containing H2/H3 with chapter format (legacy support)
-    for p in soup.find_all('p'):
-        headings = p.find_all(['h2', 'h3'])
-        for heading in headings:
-            text = heading.get_text().strip()
-            if (text.lower().startswith('chapter ') and '. ' in text) or \
-               (text.lower().startswith('appendix ') and '. ' in text) or \
-               'chapter by chapter' in text.lower() or \
-               text.lower().startswith('part one:') or \
-               text.lower().startswith('part two:') or \
-               'the appendices' in text.lower():
-                p.decompose()
+    for i, p in live_tags('p'):
+        for heading in p.find_all(['h2', 'h3']):
+            if is_summary_heading(heading.get_text().strip().lower()):
+                remove(i, p)
                 break
 
     # Remove all tables containing navigation/branding
-    for table in soup.find_all('table'):
-        text = table.get_text().lower()
-        if any(keyword in text for keyword in nav_keywords):
-            table.decompose()
+    for i, table in live_tags('table'):
+        if contains_nav(table):
+            remove(i, table)
 
     # Remove paragraphs containing navigation/branding
-    for p in soup.find_all('p'):
-        text = p.get_text().lower()
-        if any(keyword in text for keyword in nav_keywords):
-            p.decompose()
+    for i, p in live_tags('p'):
+        if contains_nav(p):
+            remove(i, p)
 
     # Remove center tags with navigation content
-    for center in soup.find_all('center'):
-        text = center.get_text().lower()
-        if any(keyword in text for keyword in nav_keywords):
-            center.decompose()
+    for i, center in live_tags('center'):
+        if contains_nav(center):
+            remove(i, center)
 
     # Remove "Table of contents" navigation headings (appears at top of each chapter)
-    for heading in soup.find_all(['h2', 'h3']):
+    for i, heading in live_tags('h2', 'h3'):
         if heading.get_text().strip().lower() == 'table of contents':
-            heading.decompose()
-
-    # Remove all external links (convert to text)
-    for a in soup.find_all('a'):
-        href = a.get('href', '')
-        if href.startswith('http://') or href.startswith('https://') or href.startswith('mailto:'):
-            a.unwrap()
+            remove(i, heading)
 
     # Remove specific images used for navigation
-    for img in soup.find_all('img'):
-        src = img.get('src', '').lower()
-        if any(nav in src for nav in ['hotkey.gif', 'order_text.gif', 'comment_text.gif',
-                                       'backward.gif', 'forward.gif', 'division-white.gif']):
-            # Remove the parent anchor if it exists
-            if img.parent and img.parent.name == 'a':
-                img.parent.decompose()
+    for i, img in live_tags('img'):
+        if is_nav_image(img):
+            # Remove the parent anchor if it exists (external links are
+            # unwrapped instead, leaving the image to be removed on its own)
+            anchor = img.parent
+            if parents[i] >= 0 and anchor.name == 'a' and not is_external_link(anchor):
+                remove(parents[i], anchor)
             else:
-                img.decompose()
+                remove(i, img)
 
-    # Remove horizontal rules
-    for hr in soup.find_all('hr'):
-        hr.decompose()
+    # Remove font tags with copyright/branding
+    for i, font in live_tags('font'):
+        if contains_nav(font):
+            remove(i, font)
 
-    # Remove script tags
-    for script in soup.find_all('script'):
-        script.decompose()
+    # Remove any remaining text nodes containing copyright notices
+    for string, parent in strings:
+        if (parent < 0 or alive[parent]) and is_copyright_notice(string):
+            string.extract()
+
+    # Descendants follow their ancestors in document order, so going in
+    # reverse handles every tag after all of its children
+    for i in reversed(range(len(kept))):
+        if not alive[i]:
+            continue
+        tag = kept[i]
+        # Remove all external links (convert to text)
+        if tag.name == 'a' and is_external_link(tag):
+            tag.unwrap()
+        # Remove empty paragraphs and other empty tags
+        elif tag.name in ('p', 'div', 'span'):
+            if not tag.get_text(strip=True) and not tag.find('img'):
+                tag.decompose()
 
-    # Remove comments
-    for comment in soup.find_all(string=lambda text: isinstance(text, Comment)):
-        comment.extract()
 
-    # Remove font tags with copyright/branding
-    for font in soup.find_all('font'):
-        text = font.get_text().lower()
-        if any(keyword in text for keyword in nav_keywords):
-            font.decompose()
+def clean_attributes(tag):
+    """Remove tppabs and other obsolete attributes from a single tag."""
+    # Remove tppabs and target attributes
+    tag.attrs.pop('tppabs', None)
+    tag.attrs.pop('target', None)
 
-    # Remove any remaining text nodes containing copyright notices
-    for element in soup.find_all(string=True):
-        if isinstance(element, NavigableString) and not isinstance(element, Comment):
-            text_lower = str(element).lower()
-            # Check if this is primarily navigation/copyright text
-            if any(keyword in text_lower for keyword in ['© 1997', 'copyright ©',
-                                                          'all rights reserved',
-                                                          'beta version']):
-                # Only remove if it's mostly this text (not part of main content)
-                if len(str(element).strip()) < 200:
-                    element.extract()
-
-    # Remove empty paragraphs and other empty tags
-    for tag in soup.find_all(['p', 'div', 'span']):
-        if not tag.get_text(strip=True) and not tag.find_all('img'):
-            tag.decompose()
-
-
-def clean_attributes(soup):
-    """Remove tppabs and other obsolete attributes."""
-    for tag in soup.find_all(True):
-        # Remove tppabs attribute
-        if tag.has_attr('tppabs'):
-            del tag['tppabs']
-
-        # Remove target attributes
-        if tag.has_attr('target'):
-            del tag['target']
-
-        # Fix links - remove external links, keep only internal ones
-        if tag.name == 'a' and tag.has_attr('href'):
-            href = tag['href']
-            # Remove external links (http/https)
-            if href.startswith('http://') or href.startswith('https://'):
-                # Convert to plain text
-                tag.unwrap()
-            # Keep internal links (remove .html extension for single file)
-            elif href.endswith('.html'):
-                tag['href'] = '#' + href.replace('.html', '')
-
-
-def extract_content(soup):
-    """Extract main content, removing navigation and cruft."""
-    # Remove navigation elements first
-    remove_navigation_elements(soup)
+    # Fix links - external links are unwrapped by remove_navigation_elements,
+    # keep internal links (remove .html extension for single file)
+    if tag.name == 'a' and tag.has_attr('href'):
+        href = tag['href']
+        if href.endswith('.html') and not href.startswith(('http://', 'https://')):
+            tag['href'] = '#' + href.replace('.html', '')
 
-    # Clean attributes
-    clean_attributes(soup)
+
+def extract_content(soup, chapter_type='chapter', chapter_num=None):
+    """Extract main content, removing navigation and cruft, with headings fixed for the TOC."""
+    # Remove navigation elements first (this also cleans attributes)
+    remove_navigation_elements(soup)
 
     # Get the body content
     body = soup.find('body')
     if not body:
         return None
 
-    # Extract all content from body
-    content = []
-    for element in body.children:
-        if isinstance(element, NavigableString):
-            if element.strip():
-                content.append(str(element))
-        elif element.name not in ['script', 'style']:
-            content.append(str(element))
-
-    html_content = ''.join(content)
+    # Fix heading hierarchy on the tree, before it is serialized
+    fix_heading_hierarchy(body, chapter_type, chapter_num)
 
-    # Decode HTML entities that may still be present in the string
-    import html as html_module
-    html_content = html_module.unescape(html_content)
+    # Extract all content from body in a single serialization
+    # (script and style tags were already removed with the navigation)
+    html_content = body.decode_contents().strip()
 
     # Fix spacing issues: add space before block-level elements if missing
-    import re
     # Add space before table/div/p tags if preceded by text without space
-    html_content = re.sub(r'([a-zA-Z0-9.])(<(?:table|div|p|h[1-6])\b)', r'\1 \2', html_content)
+    html_content = BLOCK_SPACE_RE.sub(r'\1 \2', html_content)
 
     return html_content
 
 
-def fix_heading_hierarchy(html_content, chapter_type='chapter', chapter_num=None):
+def find_title_heading(label):
+    """Find the H2 title following a chapter/appendix label H1, without walking past the next H1."""
+    for element in label.next_elements:
+        if element.name == 'h1':
+            return None
+        if element.name == 'h2':
+            return element
+    return None
+
+
+def fix_heading_hierarchy(soup, chapter_type='chapter', chapter_num=None):
     """
-    Fix heading hierarchy for proper ebook TOC.
+    Fix heading hierarchy for proper ebook TOC, modifying the tree in place.
+    - soup: parsed document or subtree (e.g. the <body> tag)
     - chapter_type: 'intro', 'chapter', 'appendix'
     - chapter_num: chapter number or appendix letter
     """
-    soup = BeautifulSoup(html_content, 'html.parser')
-
     if chapter_type == 'intro' or chapter_type == 'preface':
         # For front matter, ensure first heading is H1
         first_heading = soup.find(['h1', 'h2', 'h3'])
@@ -231,7 +303,7 @@ def fix_heading_hierarchy(html_content, chapter_type='chapter', chapter_num=None
             if text.lower().startswith('chapter ') and len(text.split()) <= 2:
                 chapter_label = tag
                 # Find the next H2 (should be the chapter title)
-                chapter_title = tag.find_next('h2')
+                chapter_title = find_title_heading(tag)
                 break
 
         if chapter_label and chapter_title:
@@ -247,56 +319,33 @@ def fix_heading_hierarchy(html_content, chapter_type='chapter', chapter_num=None
             text = tag.get_text().strip()
             if text.lower().startswith('appendix ') and len(text.split()) <= 2:
                 # Find the next H2 (should be the appendix title)
-                appendix_title = tag.find_next('h2')
+                appendix_title = find_title_heading(tag)
                 if appendix_title:
                     title_text = appendix_title.get_text().strip()
                     appendix_title.string = f"Appendix {chapter_num}. {title_text}"
                 tag.decompose()
                 break
 
-    return str(soup)
-
 
 def process_html_file(filepath, chapter_type='chapter', chapter_num=None):
     """Process a single HTML file."""
     print(f"Processing: {filepath.name}")
 
-    # First, try to detect charset from meta tag by reading as binary
-    html = None
-    detected_encoding = None
-
-    with open(filepath, 'rb') as f:
-        first_bytes = f.read(2048)  # Read first 2KB to find charset
-        # Look for charset declaration in meta tag
-        import re
-        charset_match = re.search(rb'charset=[\'"]*([a-zA-Z0-9_-]+)', first_bytes, re.IGNORECASE)
-        if charset_match:
-            detected_encoding = charset_match.group(1).decode('ascii').lower()
-
-    # Try detected encoding first, then fallback to others
-    encodings = []
-    if detected_encoding:
-        encodings.append(detected_encoding)
-    encodings.extend(['utf-8', 'iso-8859-1', 'cp1252', 'latin1'])
-
-    for encoding in encodings:
-        try:
-            with open(filepath, 'r', encoding=encoding) as f:
-                html = f.read()
-                break
-        except (UnicodeDecodeError, UnicodeError, LookupError):
-            continue
-
-    if html is None:
-        # Fallback: read as bytes and decode with error handling
-        with open(filepath, 'rb') as f:
-            html = f.read().decode('iso-8859-1', errors='replace')
+    # Decode using the charset declared in the meta tag, then utf-8, cp1252 and iso-8859-1.
+    # The declared charset is passed as a known encoding because UnicodeDammit would
+    # otherwise try user_encodings first; listing the fallbacks keeps an installed
+    # chardet/charset_normalizer from guessing before them (iso-8859-1 never fails).
+    raw = filepath.read_bytes()
+    declared = EncodingDetector.find_declared_encoding(raw, is_html=True)
+    dammit = UnicodeDammit(raw, known_definite_encodings=[declared] if declared else [],
+                           user_encodings=['utf-8', 'cp1252', 'iso-8859-1'], is_html=True)
+    html = dammit.unicode_markup
 
     # Decode HTML entities BEFORE parsing with BeautifulSoup
     import html as html_module
     html = html_module.unescape(html)
 
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = BeautifulSoup(html, PARSER, parse_only=BODY_STRAINER)
 
     # Fix archmage bug: &#9; entities split across table cells as "Type&" and "#9;Name"
     # Find all table cells
@@ -329,39 +378,20 @@ def process_html_file(filepath, chapter_type='chapter', chapter_num=None):
                                 end = elem.find(';') + 1
                                 elem.replace_with(elem[end:])
 
-    # Fix common character encoding issues and HTML entities
-    import html as html_module
+    # Fix common character encoding issues in text nodes only; translating the raw
+    # markup would turn corrupted characters in attribute values into quotes
     for text in soup.find_all(string=True):
-        if isinstance(text, str):
-            # First decode any HTML entities (&#9;, &nbsp;, etc)
-            fixed = html_module.unescape(text)
-
-            # Replace common corrupted characters
-            fixed = fixed.replace('í', "'")  # Common apostrophe corruption
-            fixed = fixed.replace('ë', '"')  # Opening quote corruption
-            fixed = fixed.replace('é', '"')  # Closing quote corruption
-            fixed = fixed.replace('ó', "'")  # Another apostrophe variant
-            fixed = fixed.replace('û', '—')  # Em dash corruption
-
-            # Replace tabs with spaces for better display
-            fixed = fixed.replace('\t', ' ')
-
-            if fixed != text:
-                text.replace_with(fixed)
+        fixed = text.translate(MOJIBAKE_MAP)
+        if fixed != text:
+            # Keep the string type so comments are still recognised as comments
+            text.replace_with(type(text)(fixed))
 
     # Extract content
-    content = extract_content(soup)
+    content = extract_content(soup, chapter_type, chapter_num)
     if not content:
         print(f"  Warning: No content extracted from {filepath.name}")
         return ""
 
-    # Fix heading hierarchy
-    content = fix_heading_hierarchy(content, chapter_type, chapter_num)
-
-    # Decode any remaining HTML entities after hierarchy fix
-    import html as html_module
-    content = html_module.unescape(content)
-
     # Add anchor for internal linking
     anchor_id = filepath.stem
     content = f'<div id="{anchor_id}">\n{content}\n</div>\n'
@@ -373,6 +403,18 @@ def combine_html_files(extracted_dir, output_file):
     """Combine all HTML files in order."""
     extracted_path = Path(extracted_dir)
 
+    # List the directory once instead of probing each file with exists().
+    # scandir's is_file() uses the directory entry type, so no stat per entry;
+    # names are matched case-insensitively, as exists() does on macOS/Windows.
+    available = {}
+    if extracted_path.is_dir():
+        with os.scandir(extracted_path) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    available[entry.name.lower()] = Path(entry.path)
+    else:
+        print(f"Warning: directory {extracted_path} not found")
+
     # Define file order (skip cover.html and toc.html as they're navigation)
     file_order = [
         ('intro.html', 'intro'),
@@ -387,8 +429,8 @@ def combine_html_files(extracted_dir, output_file):
     for letter in ['a', 'b', 'c']:
         file_order.append((f'app{letter}.html', 'appendix', letter.upper()))
 
-    # Collect all content
-    all_content = []
+    # Collect the files to process
+    jobs = []
 
     for file_info in file_order:
         # Unpack with optional chapter number
@@ -398,14 +440,17 @@ def combine_html_files(extracted_dir, output_file):
             filename, doc_type = file_info
             chapter_num = None
 
-        filepath = extracted_path / filename
-        if filepath.exists():
-            content = process_html_file(filepath, doc_type, chapter_num)
-            if content:
-                all_content.append(content)
+        if filename.lower() in available:
+            jobs.append((available[filename.lower()], doc_type, chapter_num))
         else:
             print(f"Warning: {filename} not found")
 
+    # Files are independent, so process them in parallel (starmap keeps the order)
+    with multiprocessing.Pool() as pool:
+        results = pool.starmap(process_html_file, jobs)
+
+    all_content = [content for content in results if content]
+
     # Create final HTML document
     html_template = """<!DOCTYPE html>
 <html>
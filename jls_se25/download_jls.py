@@ -1,27 +1,39 @@
 #!/usr/bin/env python3
 """Download Java Language Specification - All Chapters"""
 
+import gzip
 import re
-from urllib.request import urlopen
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import Request, urlopen
 from pathlib import Path
 
+# Main chapter div, up to the navigation footer
+CHAPTER_RE = re.compile(r'<div lang="en" class="chapter">(.*?)</div>\s*<div class="navfooter">', re.DOTALL)
+# Per-chapter table of contents
+TOC_RE = re.compile(r'<div class="toc">.*?</div>', re.DOTALL)
+
 def download(url):
     """Download a URL and return content"""
     print(f"  Downloading: {url}")
-    with urlopen(url) as response:
-        return response.read().decode('latin-1')
+    # Ask for a gzip-compressed response; the chapters are large and compress well
+    request = Request(url, headers={'Accept-Encoding': 'gzip'})
+    with urlopen(request) as response:
+        data = response.read()
+        if response.headers.get('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+        return data.decode('latin-1')
 
 def extract_chapter_content(html):
     """Extract clean chapter content, removing navigation and TOC"""
     # Find the main chapter div
-    chapter_match = re.search(r'<div lang="en" class="chapter">(.*?)</div>\s*<div class="navfooter">', html, re.DOTALL)
+    chapter_match = CHAPTER_RE.search(html)
     if not chapter_match:
         return None
 
     chapter_content = chapter_match.group(1)
 
     # Remove the TOC div
-    chapter_content = re.sub(r'<div class="toc">.*?</div>', '', chapter_content, flags=re.DOTALL)
+    chapter_content = TOC_RE.sub('', chapter_content)
 
     return chapter_content
 
@@ -54,13 +66,16 @@ def main():
     print("Downloading Java SE 25 Language Specification - All Chapters...")
     print(f"Total chapters: {len(chapters)}\n")
 
+    # Downloads are network-bound, so fetch chapters concurrently (map keeps the order)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        htmls = list(executor.map(download, [base_url + filename for filename, _ in chapters]))
+    print()
+
     all_content = []
 
-    for filename, title in chapters:
-        url = base_url + filename
+    for (_, title), html in zip(chapters, htmls):
         print(f"[{title}]")
 
-        html = download(url)
         content = extract_chapter_content(html)
 
         if content:
@@ -70,7 +85,7 @@ def main():
             print(f"  ✗ Failed to extract\n")
 
     # Create clean HTML with all chapters
-    output = f"""<!DOCTYPE html>
+    header = f"""<!DOCTYPE html>
 <html>
 <head>
     <meta charset="UTF-8">
@@ -89,17 +104,18 @@ def main():
 
 """
 
-    for content in all_content:
-        output += f'<div class="chapter">\n{content}\n</div>\n<hr>\n'
-
-    output += "</body>\n</html>"
-
-    # Save to file
+    # Save to file, writing chapters one by one instead of building the whole document in memory
     output_file = Path("/tmp/jls-se25.html")
-    output_file.write_text(output, encoding='utf-8')
+    with open(output_file, 'w', encoding='utf-8', buffering=1 << 20) as f:
+        f.write(header)
+        for content in all_content:
+            f.write('<div class="chapter">\n')
+            f.write(content)
+            f.write('\n</div>\n<hr>\n')
+        f.write("</body>\n</html>")
 
     print(f"✅ Saved to: {output_file}")
-    print(f"   File size: {len(output) / 1024:.1f} KB")
+    print(f"   File size: {output_file.stat().st_size / 1024:.1f} KB")
     print(f"   Chapters: {len(all_content)}")
 
 if __name__ == '__main__':